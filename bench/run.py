@@ -0,0 +1,238 @@
+"""Бенчмарк шлюза с локальными заглушками upstream.
+
+Поднимает заглушку billing (в процессе бенчмарка или отдельным процессом),
+запускает шлюз через uvicorn с BILLING_SERVICE_URL, указывающим на заглушку,
+и гоняет сценарии из bench/scenarios.py. Для каждого сценария выводятся
+RPS, p50/p95/p99 и RSS процесса шлюза.
+
+Сценарий users_db и старт шлюза требуют доступного DATABASE_URL.
+
+    python -m bench.run --duration 10 --concurrency 32 --output bench_output.json
+    python -m bench.run --baseline bench_output.json --threshold 0.15
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+import httpx
+from bench.scenarios import SCENARIOS, Scenario
+from bench.stubs import LatencyProfile, create_stub_server
+
+# Метрики, рост которых считается регрессией (для остальных — падение)
+HIGHER_IS_WORSE = {"p50_ms", "p95_ms", "p99_ms", "rss_mb", "error_rate"}
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+def read_rss_mb(pid: Optional[int]) -> Optional[float]:
+    """RSS процесса из /proc (доступно только на Linux)"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+async def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{url}/health/")).status_code == 200:
+                    return
+            except httpx.RequestError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Gateway at {url} did not become ready in {timeout}s")
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    duration: float,
+    warmup: float,
+    concurrency: int,
+    gateway_pid: Optional[int]
+) -> Dict[str, Optional[float]]:
+    """Закрытая модель нагрузки: `concurrency` воркеров шлют запросы без пауз"""
+    if scenario.setup is not None:
+        await scenario.setup(client)
+
+    latencies: List[float] = []
+    errors = 0
+    counter = 0
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    async def worker():
+        nonlocal errors, counter
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                return
+            counter += 1
+            try:
+                await scenario.run(client, counter)
+                ok = True
+            except (httpx.HTTPError, KeyError):
+                ok = False
+            finished = time.monotonic()
+            if now >= measure_from:
+                if ok:
+                    latencies.append((finished - now) * 1000)
+                else:
+                    errors += 1
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - measure_from
+    latencies.sort()
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "error_rate": errors / total if total else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "rss_mb": read_rss_mb(gateway_pid),
+    }
+
+def compare(report: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Список регрессий относительно baseline-отчёта"""
+    regressions = []
+    for name, metrics in report.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, value in metrics.items():
+            old = base.get(metric)
+            if metric == "requests" or value is None or old is None:
+                continue
+            if metric == "error_rate":
+                worse = value > old + threshold / 10
+            elif metric in HIGHER_IS_WORSE:
+                worse = old > 0 and value > old * (1 + threshold)
+            else:
+                worse = old > 0 and value < old * (1 - threshold)
+            if worse:
+                regressions.append(f"{name}.{metric}: {old:.2f} -> {value:.2f}")
+    return regressions
+
+def print_report(report: Dict) -> None:
+    print(f"{'scenario':<18}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'err %':>8}{'rss MB':>9}")
+    for name, m in report.items():
+        rss = f"{m['rss_mb']:.1f}" if m["rss_mb"] is not None else "-"
+        print(
+            f"{name:<18}{m['rps']:>10.1f}{m['p50_ms']:>10.2f}{m['p95_ms']:>10.2f}"
+            f"{m['p99_ms']:>10.2f}{m['error_rate'] * 100:>8.2f}{rss:>9}"
+        )
+
+async def run(args) -> Dict:
+    profile = LatencyProfile(args.latency_ms, args.jitter_ms, args.error_rate)
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    stub_server = None
+    stub_task = None
+    stub_process = None
+    gateway_process = None
+    gateway_log = None
+
+    if args.stub == "inprocess":
+        stub_server = create_stub_server(profile, "127.0.0.1", args.stub_port)
+        stub_task = asyncio.create_task(stub_server.serve())
+    elif args.stub == "subprocess":
+        stub_process = subprocess.Popen([
+            sys.executable, "-m", "bench.stubs",
+            "--port", str(args.stub_port),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+            "--error-rate", str(args.error_rate),
+        ])
+
+    gateway_url = args.gateway_url
+    gateway_pid = args.gateway_pid
+    if gateway_url is None:
+        env = dict(os.environ)
+        if args.stub != "none":
+            env["BILLING_SERVICE_URL"] = stub_url
+        gateway_log = open(args.gateway_log, "w") if args.gateway_log else None
+        log = gateway_log or subprocess.DEVNULL
+        gateway_process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.gateway_port), "--log-level", "warning"],
+            env=env,
+            stdout=log,
+            stderr=log
+        )
+        gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+        gateway_pid = gateway_process.pid
+
+    try:
+        await wait_ready(gateway_url, args.startup_timeout)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        report = {}
+        async with httpx.AsyncClient(base_url=gateway_url, limits=limits, timeout=30) as client:
+            for name in args.scenarios:
+                report[name] = await run_scenario(
+                    client, SCENARIOS[name], args.duration, args.warmup, args.concurrency, gateway_pid
+                )
+        return report
+    finally:
+        if gateway_process is not None:
+            gateway_process.terminate()
+            gateway_process.wait()
+        if gateway_log is not None:
+            gateway_log.close()
+        if stub_process is not None:
+            stub_process.terminate()
+            stub_process.wait()
+        if stub_server is not None:
+            stub_server.should_exit = True
+            await stub_task
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway benchmark")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--stub", choices=["inprocess", "subprocess", "none"], default="subprocess")
+    parser.add_argument("--stub-port", type=int, default=18001)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--gateway-url", help="Бенчмаркать уже запущенный шлюз вместо запуска нового")
+    parser.add_argument("--gateway-pid", type=int, help="PID внешнего шлюза для замера RSS")
+    parser.add_argument("--gateway-port", type=int, default=18000)
+    parser.add_argument("--gateway-log", help="Файл для stdout/stderr запущенного шлюза")
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="Сохранить отчёт в JSON")
+    parser.add_argument("--baseline", help="JSON-отчёт для сравнения (режим регрессии)")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+if __name__ == "__main__":
+    main()
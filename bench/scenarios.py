@@ -0,0 +1,63 @@
+"""Сценарии нагрузки на шлюз.
+
+Каждый сценарий — корутина `(client, i)`, выполняющая один запрос целиком
+(включая чтение тела/стрима) и бросающая исключение при ошибке.
+"""
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+import httpx
+
+@dataclass
+class Scenario:
+    name: str
+    run: Callable[[httpx.AsyncClient, int], Awaitable[None]]
+    setup: Optional[Callable[[httpx.AsyncClient], Awaitable[None]]] = None
+
+async def billing_debit(client: httpx.AsyncClient, i: int) -> None:
+    response = await client.post(
+        "/billing/quota/debit",
+        json={"user_id": f"user-{i % 100}", "action": "chat", "units": 1, "reason": "bench"},
+        headers={"Idempotency-Key": str(uuid.uuid4())}
+    )
+    response.raise_for_status()
+
+async def billing_balance(client: httpx.AsyncClient, i: int) -> None:
+    response = await client.get("/billing/balance", params={"user_id": f"user-{i % 100}"})
+    response.raise_for_status()
+
+async def conversation_sse(client: httpx.AsyncClient, i: int) -> None:
+    async with client.stream("POST", "/conversation/") as response:
+        response.raise_for_status()
+        async for _ in response.aiter_bytes():
+            pass
+
+async def tpl_run(client: httpx.AsyncClient, i: int) -> None:
+    async with client.stream("POST", f"/tpl/claim-{i % 10}/run") as response:
+        response.raise_for_status()
+        async for _ in response.aiter_bytes():
+            pass
+
+_users: Dict[str, int] = {}
+
+async def users_setup(client: httpx.AsyncClient) -> None:
+    response = await client.post(
+        "/users/",
+        params={"email": f"bench-{uuid.uuid4()}@example.com", "full_name": "Bench User"}
+    )
+    response.raise_for_status()
+    _users["id"] = response.json()["id"]
+
+async def users_db(client: httpx.AsyncClient, i: int) -> None:
+    response = await client.get(f"/users/{_users['id']}")
+    response.raise_for_status()
+
+SCENARIOS: Dict[str, Scenario] = {
+    scenario.name: scenario for scenario in [
+        Scenario("billing_debit", billing_debit),
+        Scenario("billing_balance", billing_balance),
+        Scenario("conversation_sse", conversation_sse),
+        Scenario("tpl_run", tpl_run),
+        Scenario("users_db", users_db, setup=users_setup),
+    ]
+}
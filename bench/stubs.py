@@ -0,0 +1,75 @@
+"""Локальные заглушки upstream-микросервисов для бенчмарков.
+
+Запуск отдельным процессом:
+    python -m bench.stubs --port 8001 --latency-ms 20 --jitter-ms 5 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import uuid
+from dataclasses import dataclass
+from fastapi import FastAPI, HTTPException, Query
+import uvicorn
+
+@dataclass
+class LatencyProfile:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+
+    async def apply(self) -> None:
+        """Имитирует задержку и ошибки upstream согласно профилю"""
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise HTTPException(status_code=500, detail="Injected upstream error")
+
+def create_billing_stub(profile: LatencyProfile) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/internal/billing/check")
+    async def check(data: dict):
+        await profile.apply()
+        return {"allowed": True, "balance": 1000.0}
+
+    @app.post("/internal/billing/debit")
+    async def debit(data: dict):
+        await profile.apply()
+        return {"balance": 1000.0 - data.get("units", 0), "tx_id": str(uuid.uuid4())}
+
+    @app.post("/internal/billing/credit")
+    async def credit(data: dict):
+        await profile.apply()
+        return {"balance": 1000.0 + data.get("units", 0), "tx_id": str(uuid.uuid4())}
+
+    @app.get("/internal/billing/balance")
+    async def balance(user_id: str = Query(...)):
+        await profile.apply()
+        return {"balance": 1000.0, "plan": {"id": "basic"}}
+
+    @app.post("/internal/billing/plan/apply")
+    async def plan_apply(data: dict):
+        await profile.apply()
+        return {"plan_id": data.get("plan_id"), "new_balance": 1000.0}
+
+    return app
+
+def create_stub_server(profile: LatencyProfile, host: str, port: int) -> uvicorn.Server:
+    """Сервер заглушки billing, который можно запустить в текущем event loop"""
+    config = uvicorn.Config(create_billing_stub(profile), host=host, port=port, log_level="warning")
+    return uvicorn.Server(config)
+
+def main():
+    parser = argparse.ArgumentParser(description="Billing upstream stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    profile = LatencyProfile(args.latency_ms, args.jitter_ms, args.error_rate)
+    create_stub_server(profile, args.host, args.port).run()
+
+if __name__ == "__main__":
+    main()
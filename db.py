@@ -9,4 +9,12 @@ async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False
 
 async def get_session() -> AsyncSession:
     async with async_session() as session:
-        yield session 
\ No newline at end of file
+        yield session 
+
+def insert_ignore(session: AsyncSession, model):
+    """INSERT ... ON CONFLICT DO NOTHING для диалекта текущей сессии"""
+    if session.bind.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(model).on_conflict_do_nothing()
@@ -2,9 +2,16 @@ from fastapi import FastAPI
 from routers import user, chat, tpl, billing, user, auth
 from models.user import Base
 from db import engine
+from services.tracing import TracingMiddleware, instrument_engine, exporter
+from services.concurrency_limiter import PriorityMiddleware
+from services.microservice_client import microservice_client
+from services.tpl_sessions import tpl_session_store
 import asyncio
 
 app = FastAPI()
+app.add_middleware(PriorityMiddleware)
+app.add_middleware(TracingMiddleware)
+instrument_engine(engine)
 app.include_router(auth.router)
 app.include_router(chat.router)
 app.include_router(tpl.router)
@@ -14,4 +21,11 @@ app.include_router(user.router)
 @app.on_event("startup")
 async def on_startup():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all) 
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+    app.state.tpl_compaction = asyncio.create_task(tpl_session_store.run_compaction())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.tpl_compaction.cancel()
+    await microservice_client.close()
+    exporter.shutdown()
@@ -0,0 +1,11 @@
+from sqlalchemy import Column, String, Float, JSON, Boolean
+from models.user import Base
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    # Ключ занят запросом, который ещё выполняется
+    pending = Column(Boolean, nullable=False, default=False)
+    body = Column(JSON)
+    expires_at = Column(Float, index=True, nullable=False)
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, Integer, String, JSON, Index
+from models.user import Base
+
+class TplSession(Base):
+    __tablename__ = "tpl_sessions"
+    user_id = Column(String, primary_key=True)
+    code = Column(String, primary_key=True)
+    # Записи с seq <= base_seq сброшены через reset
+    base_seq = Column(Integer, nullable=False, default=0)
+    head_seq = Column(Integer, nullable=False, default=0)
+
+class TplHistoryEntry(Base):
+    __tablename__ = "tpl_history"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, nullable=False)
+    code = Column(String, nullable=False)
+    seq = Column(Integer, nullable=False)
+    t = Column(String, nullable=False)
+    text = Column(String)
+    files = Column(JSON)
+
+    __table_args__ = (
+        Index("ix_tpl_history_session_seq", "user_id", "code", "seq", unique=True),
+    )
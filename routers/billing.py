@@ -1,7 +1,8 @@
-from fastapi import APIRouter, status, Query, Body, Depends
+from fastapi import APIRouter, status, Query, Body, Depends, Header
 from pydantic import BaseModel, Field
 from typing import Optional
 from services.microservice_client import microservice_client
+from services.idempotency import idempotency_store, request_fingerprint
 
 router = APIRouter()
 
@@ -50,6 +51,22 @@ class ApplyPlanResponse(BaseModel):
     plan_id: str
     new_balance: float
 
+async def idempotent_proxy(path: str, data: dict, idempotency_key: Optional[str]):
+    """Проксирует POST к billing не более одного раза на Idempotency-Key"""
+    return await idempotency_store.execute(
+        key=idempotency_key,
+        fingerprint=request_fingerprint(path, data),
+        call=lambda: microservice_client.proxy_request(
+            service_name="billing",
+            method="POST",
+            path=path,
+            data=data,
+            # billing может сам отсечь повтор, если ответ шлюзу потерялся
+            headers={"Idempotency-Key": idempotency_key} if idempotency_key is not None else None
+        ),
+        scope=path
+    )
+
 @router.post("/billing/quota/check", response_model=CheckBalanceResponse)
 async def quota_check(request: CheckBalanceRequest):
     """Проксирует запрос проверки баланса к микросервису billing"""
@@ -61,24 +78,20 @@ async def quota_check(request: CheckBalanceRequest):
     )
 
 @router.post("/billing/quota/debit", response_model=DebitResponse)
-async def quota_debit(request: DebitRequest):
+async def quota_debit(
+    request: DebitRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Проксирует запрос списания средств к микросервису billing"""
-    return await microservice_client.proxy_request(
-        service_name="billing",
-        method="POST",
-        path="/internal/billing/debit",
-        data=request.dict()
-    )
+    return await idempotent_proxy("/internal/billing/debit", request.dict(), idempotency_key)
 
 @router.post("/billing/quota/credit", response_model=CreditResponse)
-async def quota_credit(request: CreditRequest):
+async def quota_credit(
+    request: CreditRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Проксирует запрос пополнения баланса к микросервису billing"""
-    return await microservice_client.proxy_request(
-        service_name="billing",
-        method="POST",
-        path="/internal/billing/credit",
-        data=request.dict()
-    )
+    return await idempotent_proxy("/internal/billing/credit", request.dict(), idempotency_key)
 
 @router.get("/billing/balance", response_model=BalanceResponse)
 async def get_balance(user_id: str = Query(..., description="ID пользователя")):
@@ -91,11 +104,9 @@ async def get_balance(user_id: str = Query(..., description="ID пользова
     )
 
 @router.post("/billing/plan/apply", response_model=ApplyPlanResponse)
-async def apply_plan(request: ApplyPlanRequest):
+async def apply_plan(
+    request: ApplyPlanRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Проксирует запрос применения плана к микросервису billing"""
-    return await microservice_client.proxy_request(
-        service_name="billing",
-        method="POST",
-        path="/internal/billing/plan/apply",
-        data=request.dict()
-    ) 
\ No newline at end of file
+    return await idempotent_proxy("/internal/billing/plan/apply", request.dict(), idempotency_key) 
\ No newline at end of file
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, status, UploadFile, File, Form, Body
+from fastapi import APIRouter, status, UploadFile, File, Form, Body, Query, Response, HTTPException
 from pydantic import BaseModel, RootModel
 from typing import List, Optional
 from fastapi.responses import StreamingResponse, JSONResponse
+from services.tpl_sessions import tpl_session_store
 import io
 
 router = APIRouter()
@@ -22,6 +23,19 @@ class TplHistoryResponse(RootModel[List[TplHistoryItem]]):
 class TplStatusResponse(BaseModel):
     status: str
 
+class TplHistoryRef(BaseModel):
+    # head_seq сессии, до которого у клиента уже есть история
+    since_seq: int
+    # Новые записи после since_seq
+    delta: List[TplHistoryItem] = []
+
+def _pdf_response(code: str, head_seq: Optional[int] = None) -> StreamingResponse:
+    pdf_bytes = b"%PDF-1.4...mock..."
+    headers = {"Content-Disposition": f"attachment; filename={code}.pdf"}
+    if head_seq is not None:
+        headers["X-History-Seq"] = str(head_seq)
+    return StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers=headers)
+
 # --- Public Endpoints ---
 @router.post("/tpl/{code}/add", response_model=TplStatusResponse)
 def tpl_add(code: str, req: TplAddRequest):
@@ -45,27 +59,58 @@ def tpl_reset(code: str):
     return
 
 # --- Internal Endpoints ---
+# История сессий доступна только сервисам: user_id в них передаёт вызывающий сервис,
+# а не конечный пользователь
 @router.post("/internal/tpl/{code}/add", response_model=TplStatusResponse)
-def internal_tpl_add(code: str, req: TplAddRequest):
+async def internal_tpl_add(code: str, req: TplAddRequest, user_id: str = Query(...)):
+    await tpl_session_store.append(user_id, code, [{"t": "user", "text": req.text, "files": req.files}])
     return {"status": "ok"}
 
 @router.get("/internal/tpl/{code}/history", response_model=List[TplHistoryItem])
-def internal_tpl_history(code: str):
-    return [
-        {"t": "user", "text": "Нужна претензия по договору 14/05", "files": [{"filename": "contract.pdf", "download_url": "url"}]},
-        {"t": "assistant", "text": "Задайте, пожалуйста, сумму долга", "files": []}
-    ]
+async def internal_tpl_history(
+    code: str,
+    response: Response,
+    user_id: str = Query(...),
+    since: Optional[int] = Query(None, description="Вернуть только записи после этого seq")
+):
+    head_seq, items = await tpl_session_store.history(user_id, code, since)
+    response.headers["X-History-Seq"] = str(head_seq)
+    return items
 
 @router.post("/internal/tpl/{code}/run")
-def internal_tpl_run(code: str):
-    pdf_bytes = b"%PDF-1.4...mock..."
-    return StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename={code}.pdf"})
+async def internal_tpl_run(code: str, user_id: str = Query(...)):
+    head_seq = await tpl_session_store.head(user_id, code)
+    return _pdf_response(code, head_seq)
 
 @router.post("/internal/tpl/{code}/reset", status_code=status.HTTP_204_NO_CONTENT)
-def internal_tpl_reset(code: str):
+async def internal_tpl_reset(code: str, user_id: str = Query(...)):
+    await tpl_session_store.reset(user_id, code)
     return
 
 @router.post("/internal/tpl/{code}/direct-run")
-def internal_tpl_direct_run(code: str, user_id: str = Body(...), chat_history: list = Body(...)):
-    pdf_bytes = b"%PDF-1.4...mock..."
-    return StreamingResponse(io.BytesIO(pdf_bytes), media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename={code}.pdf"}) 
\ No newline at end of file
+async def internal_tpl_direct_run(
+    code: str,
+    user_id: str = Body(...),
+    chat_history: Optional[list] = Body(None),
+    history_ref: Optional[TplHistoryRef] = Body(None)
+):
+    """Запуск шаблона с полной историей (chat_history) или ссылкой на сессию с дельтой (history_ref)"""
+    if history_ref is None:
+        if chat_history is None:
+            raise HTTPException(status_code=422, detail="chat_history or history_ref is required")
+        return _pdf_response(code)
+
+    if history_ref.delta:
+        # Клиент присылает только новые записи; если он разошёлся с сессией — 409
+        head_seq = await tpl_session_store.append(
+            user_id, code, [item.model_dump() for item in history_ref.delta], expected_seq=history_ref.since_seq
+        )
+    else:
+        head_seq = await tpl_session_store.head(user_id, code)
+        if history_ref.since_seq != head_seq:
+            raise HTTPException(
+                status_code=409,
+                detail="History is out of sync",
+                headers={"X-History-Seq": str(head_seq)}
+            )
+    return _pdf_response(code, head_seq)
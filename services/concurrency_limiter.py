@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Callable, Deque, List, Optional
+from services.errors import UpstreamNotReached
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньше — важнее
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Префиксы путей и их приоритеты; первое совпадение выигрывает
+PRIORITY_RULES = [
+    ("/billing/balance", PRIORITY_INTERACTIVE),
+    ("/billing/quota/check", PRIORITY_INTERACTIVE),
+    ("/conversation/", PRIORITY_INTERACTIVE),
+    ("/upload_conversations/", PRIORITY_BULK),
+    ("/tasks/embeddings/reindex/", PRIORITY_BULK),
+]
+
+_request_priority: ContextVar[int] = ContextVar("request_priority", default=PRIORITY_NORMAL)
+
+def classify_priority(path: str) -> int:
+    for prefix, priority in PRIORITY_RULES:
+        if path.startswith(prefix):
+            return priority
+    return PRIORITY_NORMAL
+
+def current_priority() -> int:
+    return _request_priority.get()
+
+class PriorityMiddleware:
+    """ASGI-middleware: определяет приоритет входящего запроса по пути"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _request_priority.set(classify_priority(scope["path"]))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_priority.reset(token)
+
+class AdaptiveConcurrencyLimiter:
+    """Адаптивный лимит одновременных запросов к одному upstream.
+
+    Сглаженный RTT сравнивается с минимальным RTT за последние окна выборок
+    (градиент, как в Netflix Gradient2): пока сглаженный RTT не превышает
+    `tolerance` × минимум, лимит растёт с запасом sqrt(limit), а дальше
+    сжимается пропорционально росту задержки. Ошибки upstream умножают лимит
+    на `backoff`. Лимит пересчитывается не чаще раза за сглаженный RTT. Запросы сверх лимита ждут
+    в ограниченной очереди по приоритету; при переполнении первыми
+    вытесняются менее важные, а вытесненные и не дождавшиеся получают 503
+    с Retry-After.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: float,
+        min_limit: float,
+        max_limit: float,
+        max_queue: int,
+        queue_timeout: float,
+        tolerance: float = 2.0,
+        backoff: float = 0.9,
+        smoothing: float = 0.2,
+        window_size: int = 50,
+        windows: int = 5,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.name = name
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.min_rtt: Optional[float] = None
+        self.avg_rtt = 0.0
+        self.smoothing = smoothing
+        self.window_size = window_size
+        self.clock = clock
+        # Минимумы RTT завершённых окон и текущего окна
+        self._window_mins: Deque[float] = deque(maxlen=windows)
+        self._current_min: Optional[float] = None
+        self._current_count = 0
+        self._last_update = float("-inf")
+        self._dropped = False
+        self._waiters: List[list] = []
+        self._seq = itertools.count()
+
+    def _capacity(self) -> int:
+        return max(1, int(self.limit))
+
+    def _queued(self) -> int:
+        return sum(1 for entry in self._waiters if not entry[2].done())
+
+    def _retry_after(self) -> int:
+        """Оценка времени, за которое освободится очередь, в секундах"""
+        drain = (self._queued() + 1) * (self.avg_rtt or 1.0) / self._capacity()
+        return max(1, math.ceil(drain))
+
+    def _overloaded(self) -> UpstreamNotReached:
+        return UpstreamNotReached(
+            status_code=503,
+            detail=f"Service {self.name} overloaded",
+            headers={"Retry-After": str(self._retry_after())}
+        )
+
+    def _evict_for(self, priority: int) -> bool:
+        """Вытесняет самый новый из наименее важных ожидающих, если он ниже `priority`"""
+        victim = None
+        for entry in self._waiters:
+            if entry[2].done():
+                continue
+            if victim is None or (entry[0], entry[1]) > (victim[0], victim[1]):
+                victim = entry
+        if victim is None or victim[0] <= priority:
+            return False
+        victim[2].set_exception(self._overloaded())
+        return True
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL) -> None:
+        if not self._queued() and self.in_flight < self._capacity():
+            self.in_flight += 1
+            return
+        if self._queued() >= self.max_queue and not self._evict_for(priority):
+            logger.warning(f"Shedding request to {self.name}: queue full")
+            raise self._overloaded()
+
+        if len(self._waiters) > 2 * self.max_queue:
+            # Чистим кучу от отменённых и вытесненных ожидающих
+            self._waiters = [entry for entry in self._waiters if not entry[2].done()]
+            heapq.heapify(self._waiters)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), future])
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shedding request to {self.name}: queue timeout")
+            raise self._overloaded()
+        except asyncio.CancelledError:
+            # Слот мог быть выдан одновременно с отменой — возвращаем его
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, rtt: float, dropped: bool = False) -> None:
+        """Освобождает слот и подстраивает лимит по RTT ответа"""
+        self.in_flight -= 1
+        self._update_limit(rtt, dropped)
+        self._wake()
+
+    def _observe_rtt(self, rtt: float) -> None:
+        self.avg_rtt = rtt if not self.avg_rtt else self.avg_rtt * 0.9 + rtt * 0.1
+        if self._current_min is None or rtt < self._current_min:
+            self._current_min = rtt
+        self._current_count += 1
+        if self._current_count >= self.window_size:
+            self._window_mins.append(self._current_min)
+            self._current_min = None
+            self._current_count = 0
+        # Минимум только по последним окнам, чтобы базовый RTT мог вырасти вслед за upstream
+        candidates = list(self._window_mins)
+        if self._current_min is not None:
+            candidates.append(self._current_min)
+        self.min_rtt = min(candidates)
+
+    def _update_limit(self, rtt: float, dropped: bool) -> None:
+        self._observe_rtt(rtt)
+        self._dropped = self._dropped or dropped
+        now = self.clock()
+        # Лимит пересчитывается не чаще раза за сглаженный RTT: иначе десятки
+        # ответов одного «поколения» запросов успевают многократно его сдвинуть
+        if now - self._last_update < self.avg_rtt:
+            return
+        self._last_update = now
+        if self._dropped:
+            self._dropped = False
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.min_rtt / self.avg_rtt))
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        if new_limit > self.limit and self.in_flight + 1 < self.limit / 2:
+            # Лимит не используется — растить его незачем
+            return
+        # Сглаживаем, чтобы отдельный всплеск задержки не двигал лимит резко
+        new_limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < self._capacity():
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+def create_limiter(name: str) -> AdaptiveConcurrencyLimiter:
+    return AdaptiveConcurrencyLimiter(
+        name,
+        initial_limit=float(os.getenv("UPSTREAM_LIMIT_INITIAL", "20")),
+        min_limit=float(os.getenv("UPSTREAM_LIMIT_MIN", "1")),
+        max_limit=float(os.getenv("UPSTREAM_LIMIT_MAX", "200")),
+        max_queue=int(os.getenv("UPSTREAM_QUEUE_SIZE", "100")),
+        queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "5"))
+    )
@@ -0,0 +1,8 @@
+from fastapi import HTTPException
+
+class UpstreamNotReached(HTTPException):
+    """Запрос гарантированно не дошёл до микросервиса (сброшен лимитером, нет соединения).
+
+    Такой запрос можно безопасно повторить, в отличие от таймаута ответа или 5xx,
+    когда микросервис мог успеть выполнить операцию.
+    """
@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+from db import async_session, insert_ignore
+from models.idempotency import IdempotencyRecord
+from services.errors import UpstreamNotReached
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    body: Any
+    expires_at: float
+    pending: bool = False
+
+def request_fingerprint(path: str, data: Optional[Dict]) -> str:
+    """Отпечаток запроса: один и тот же ключ нельзя переиспользовать с другим телом"""
+    payload = json.dumps({"path": path, "data": data}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def validate_idempotency_key(key: str) -> str:
+    """Проверяет значение заголовка Idempotency-Key, как его прислал клиент"""
+    if not key or len(key) > MAX_KEY_LENGTH or any(c.isspace() for c in key):
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+    return key
+
+def _is_safe_to_retry(error: Exception) -> bool:
+    """Микросервис точно не выполнил запрос, и ключ можно освободить"""
+    if isinstance(error, UpstreamNotReached):
+        return True
+    return isinstance(error, HTTPException) and 400 <= error.status_code < 500
+
+def _in_progress() -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail="Request with this Idempotency-Key is still in progress",
+        headers={"Retry-After": "1"}
+    )
+
+class IdempotencyStore(ABC):
+    """Базовый слой Idempotency-Key.
+
+    Перед вызовом микросервиса ключ атомарно занимается записью `pending`.
+    Успешный ответ сохраняется на `ttl` секунд. Ошибка освобождает ключ,
+    только если запрос точно не выполнен (не дошёл до микросервиса или
+    отклонён с 4xx); после таймаута или 5xx ключ остаётся `pending` до
+    истечения `pending_ttl`, чтобы повтор не списал дважды. Дубликаты в том же процессе ждут
+    результат первого запроса, дубликаты с других инстансов опрашивают
+    хранилище до `poll_timeout` и затем получают 409 с Retry-After.
+    Вызов микросервиса доводится до конца, даже если клиент отключился.
+    """
+
+    def __init__(self, ttl: float, pending_ttl: float, poll_timeout: float):
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.poll_timeout = poll_timeout
+        # Запросы, выполняющиеся в этом процессе: ключ -> (отпечаток, задача)
+        self._inflight: Dict[str, Tuple[str, asyncio.Task]] = {}
+
+    @abstractmethod
+    async def _claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """Занимает ключ записью pending; если ключ уже занят, возвращает его запись"""
+
+    @abstractmethod
+    async def _complete(self, key: str, response: StoredResponse) -> None:
+        """Сохраняет успешный ответ вместо записи pending"""
+
+    @abstractmethod
+    async def _release(self, key: str) -> None:
+        """Освобождает ключ после неуспешного запроса"""
+
+    @staticmethod
+    def _check_fingerprint(expected: str, fingerprint: str) -> None:
+        if expected != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used with a different request"
+            )
+
+    async def execute(
+        self,
+        key: Optional[str],
+        fingerprint: str,
+        call: Callable[[], Awaitable[Any]],
+        scope: str = ""
+    ) -> Any:
+        """Выполняет `call` не более одного раза для пары (ключ, отпечаток).
+
+        `key` — значение заголовка клиента; ключи разных `scope` не пересекаются.
+        """
+        if key is None:
+            return await call()
+        key = f"{scope}:{validate_idempotency_key(key)}"
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._check_fingerprint(inflight[0], fingerprint)
+            logger.info(f"Idempotency-Key {key}: waiting for in-flight request")
+            task = inflight[1]
+        else:
+            task = asyncio.ensure_future(self._execute_once(key, fingerprint, call))
+            self._inflight[key] = (fingerprint, task)
+            task.add_done_callback(lambda done: self._forget(key, done))
+        try:
+            # shield: отключение клиента не отменяет уже начатое списание
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                # Отменён сам вызов (например, при остановке), а не этот запрос
+                raise _in_progress()
+            raise
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight[1] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Помечаем исключение как полученное, если все ожидающие уже ушли
+            task.exception()
+
+    async def _execute_once(
+        self,
+        key: str,
+        fingerprint: str,
+        call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        deadline = time.monotonic() + self.poll_timeout
+        delay = 0.05
+        while True:
+            stored = await self._claim(key, fingerprint)
+            if stored is None:
+                break
+            self._check_fingerprint(stored.fingerprint, fingerprint)
+            if not stored.pending:
+                logger.info(f"Idempotency-Key {key}: replaying stored response")
+                return stored.body
+            # Ключ занят другим инстансом — ждём его результат
+            if time.monotonic() >= deadline:
+                raise _in_progress()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        try:
+            result = await call()
+        except Exception as error:
+            if not _is_safe_to_retry(error):
+                # Микросервис мог выполнить запрос: повтор получит 409 до истечения pending_ttl
+                logger.warning(f"Idempotency-Key {key}: outcome unknown, keeping key pending")
+                raise
+            try:
+                await self._release(key)
+            except Exception as e:
+                logger.error(f"Idempotency-Key {key}: failed to release key: {e}")
+            raise
+        try:
+            await self._complete(key, StoredResponse(fingerprint, result, time.time() + self.ttl))
+        except Exception as e:
+            # Запрос уже выполнен микросервисом: отдаём результат, а ключ остаётся
+            # занятым pending до истечения pending_ttl, чтобы повтор не выполнился снова
+            logger.error(f"Idempotency-Key {key}: failed to store response: {e}")
+        return result
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """Ограниченное LRU-хранилище в памяти процесса"""
+
+    def __init__(self, ttl: float, pending_ttl: float, poll_timeout: float, max_entries: int):
+        super().__init__(ttl, pending_ttl, poll_timeout)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, StoredResponse]" = OrderedDict()
+
+    def _put(self, key: str, response: StoredResponse) -> None:
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        stored = self._entries.get(key)
+        if stored is not None and stored.expires_at > time.time():
+            self._entries.move_to_end(key)
+            return stored
+        self._put(key, StoredResponse(fingerprint, None, time.time() + self.pending_ttl, pending=True))
+        return None
+
+    async def _complete(self, key: str, response: StoredResponse) -> None:
+        self._put(key, response)
+
+    async def _release(self, key: str) -> None:
+        stored = self._entries.get(key)
+        if stored is not None and stored.pending:
+            del self._entries[key]
+
+class PostgresIdempotencyStore(IdempotencyStore):
+    """Хранилище в таблице idempotency_keys, общее для всех инстансов шлюза"""
+
+    def __init__(self, ttl: float, pending_ttl: float, poll_timeout: float, session_factory=async_session):
+        super().__init__(ttl, pending_ttl, poll_timeout)
+        self.session_factory = session_factory
+
+    async def _claim(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        now = time.time()
+        async with self.session_factory() as session:
+            await session.execute(
+                delete(IdempotencyRecord)
+                .where(IdempotencyRecord.key == key, IdempotencyRecord.expires_at <= now)
+            )
+            result = await session.execute(
+                insert_ignore(session, IdempotencyRecord).values(
+                    key=key,
+                    fingerprint=fingerprint,
+                    pending=True,
+                    body=None,
+                    expires_at=now + self.pending_ttl
+                )
+            )
+            if result.rowcount == 1:
+                await session.commit()
+                return None
+            record = (await session.execute(
+                select(IdempotencyRecord).where(IdempotencyRecord.key == key)
+            )).scalar_one_or_none()
+            await session.commit()
+        if record is None:
+            # Запись удалили между INSERT и SELECT — пробуем занять ключ снова
+            return await self._claim(key, fingerprint)
+        return StoredResponse(record.fingerprint, record.body, record.expires_at, record.pending)
+
+    async def _complete(self, key: str, response: StoredResponse) -> None:
+        async with self.session_factory() as session:
+            await session.execute(
+                delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= time.time())
+            )
+            await session.execute(
+                update(IdempotencyRecord)
+                .where(IdempotencyRecord.key == key)
+                .values(pending=False, body=response.body, expires_at=response.expires_at)
+            )
+            await session.commit()
+
+    async def _release(self, key: str) -> None:
+        async with self.session_factory() as session:
+            await session.execute(
+                delete(IdempotencyRecord)
+                .where(IdempotencyRecord.key == key, IdempotencyRecord.pending.is_(True))
+            )
+            await session.commit()
+
+def create_idempotency_store() -> IdempotencyStore:
+    backend = os.getenv("IDEMPOTENCY_STORE", "memory")
+    ttl = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+    pending_ttl = float(os.getenv("IDEMPOTENCY_PENDING_TTL", "300"))
+    poll_timeout = float(os.getenv("IDEMPOTENCY_POLL_TIMEOUT", "10"))
+    if backend == "postgres":
+        return PostgresIdempotencyStore(ttl, pending_ttl, poll_timeout)
+    if backend != "memory":
+        raise ValueError(f"Unknown IDEMPOTENCY_STORE backend: {backend}")
+    return InMemoryIdempotencyStore(
+        ttl, pending_ttl, poll_timeout, int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+    )
+
+# Создаём экземпляр хранилища
+idempotency_store = create_idempotency_store()
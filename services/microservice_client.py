@@ -2,7 +2,11 @@ import httpx
 from typing import Dict, Any, Optional
 from fastapi import HTTPException
 import os
+import time
 import logging
+from services.concurrency_limiter import create_limiter, current_priority
+from services.errors import UpstreamNotReached
+from services.tracing import tracer, SPAN_KIND_CLIENT, UpstreamPhaseRecorder
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -11,11 +15,19 @@ logger = logging.getLogger(__name__)
 class MicroserviceClient:
     def __init__(self):
         self.base_urls = {
-            "billing": "http://host.docker.internal:8001",  # Подключение к внешнему сервису
+            "billing": os.getenv("BILLING_SERVICE_URL", "http://host.docker.internal:8001"),  # Подключение к внешнему сервису
             # Добавь другие микросервисы по мере необходимости
         }
+        # Адаптивный лимит одновременных запросов на каждый микросервис
+        self.limiters = {name: create_limiter(name) for name in self.base_urls}
         # Внутренний ключ для аутентификации между сервисами
         self.internal_key = os.getenv("INTERNAL_SERVICE_KEY", "gateway-secret-key-2024")
+        # Общий клиент: соединения и SSL-контекст не создаются заново на каждый запрос.
+        # Число соединений ограничивают лимитеры, иначе ожидание в пуле httpx попадало бы в RTT
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=None, max_keepalive_connections=100))
+
+    async def close(self):
+        await self.client.aclose()
     
     async def proxy_request(
         self, 
@@ -45,19 +57,40 @@ class MicroserviceClient:
         
         logger.info(f"Request headers: {request_headers}")
         
-        async with httpx.AsyncClient() as client:
+        with tracer.span(f"{method.upper()} {service_name}", SPAN_KIND_CLIENT) as span:
+            # Передаём контекст трассировки в upstream (W3C Trace Context)
+            traceparent = span.traceparent()
+            if traceparent:
+                request_headers["traceparent"] = traceparent
+            extensions = None
+            if span.sampled:
+                span.set_attribute("peer.service", service_name)
+                span.set_attribute("http.method", method.upper())
+                span.set_attribute("http.url", url)
+                extensions = {"trace": UpstreamPhaseRecorder(span)}
+            
+            limiter = self.limiters[service_name]
+            queued_at = time.monotonic()
+            await limiter.acquire(current_priority())
+            started = time.monotonic()
+            span.set_attribute("gateway.queue_ms", (started - queued_at) * 1000)
+            rtt = None
+            dropped = False
             try:
                 if method.upper() == "GET":
-                    response = await client.get(url, params=params, headers=request_headers)
+                    response = await self.client.get(url, params=params, headers=request_headers, extensions=extensions)
                 elif method.upper() == "POST":
-                    response = await client.post(url, json=data, params=params, headers=request_headers)
+                    response = await self.client.post(url, json=data, params=params, headers=request_headers, extensions=extensions)
                 elif method.upper() == "PUT":
-                    response = await client.put(url, json=data, params=params, headers=request_headers)
+                    response = await self.client.put(url, json=data, params=params, headers=request_headers, extensions=extensions)
                 elif method.upper() == "DELETE":
-                    response = await client.delete(url, params=params, headers=request_headers)
+                    response = await self.client.delete(url, params=params, headers=request_headers, extensions=extensions)
                 else:
                     raise HTTPException(status_code=400, detail=f"Method {method} not supported")
+                # Для лимита учитываем только обмен с upstream, без разбора ответа в шлюзе
+                rtt = time.monotonic() - started
                 
+                span.set_attribute("http.status_code", response.status_code)
                 logger.info(f"Response status: {response.status_code}")
                 logger.info(f"Response body: {response.text}")
                 
@@ -66,10 +99,19 @@ class MicroserviceClient:
                 
             except httpx.HTTPStatusError as e:
                 logger.error(f"HTTP error: {e.response.status_code} - {e.response.text}")
+                dropped = e.response.status_code >= 500
                 raise HTTPException(status_code=e.response.status_code, detail=str(e))
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Соединение не установлено — запрос до микросервиса не дошёл
+                logger.error(f"Request error: {e}")
+                dropped = True
+                raise UpstreamNotReached(status_code=503, detail=f"Service {service_name} unavailable")
             except httpx.RequestError as e:
                 logger.error(f"Request error: {e}")
+                dropped = True
                 raise HTTPException(status_code=503, detail=f"Service {service_name} unavailable")
+            finally:
+                limiter.release(rtt if rtt is not None else time.monotonic() - started, dropped)
 
 # Создаём экземпляр клиента
 microservice_client = MicroserviceClient() 
\ No newline at end of file
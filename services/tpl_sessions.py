@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+from db import async_session, insert_ignore
+from models.tpl_session import TplSession, TplHistoryEntry
+
+logger = logging.getLogger(__name__)
+
+SessionKey = Tuple[str, str]
+
+class _CachedSession:
+    __slots__ = ("base_seq", "head_seq", "tail")
+
+    def __init__(self, base_seq: int, head_seq: int, tail_size: int):
+        self.base_seq = base_seq
+        self.head_seq = head_seq
+        # Последние записи сессии: (seq, item)
+        self.tail: Deque[Tuple[int, dict]] = deque(maxlen=tail_size)
+
+    def covers(self, since_seq: int) -> bool:
+        """Есть ли в хвосте все записи после since_seq"""
+        if since_seq >= self.head_seq:
+            return True
+        return bool(self.tail) and self.tail[0][0] <= since_seq + 1
+
+def _entry_to_item(entry: TplHistoryEntry) -> dict:
+    return {"t": entry.t, "text": entry.text, "files": entry.files}
+
+class TplSessionStore:
+    """История шаблонных сессий: append-only лог на (user_id, code) в Postgres.
+
+    reset не удаляет записи, а сдвигает base_seq до head_seq, поэтому работает
+    за O(1); сброшенные записи удаляет фоновая компакция раз в
+    `compact_interval` секунд. Последние `tail_size` записей активных сессий держатся в памяти
+    процесса: чтение сверяет (base_seq, head_seq) кэша со строкой tpl_sessions
+    по первичному ключу и перечитывает хвост, только если сессию изменил
+    другой инстанс.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int,
+        tail_size: int,
+        compact_interval: float = 3600,
+        session_factory=async_session
+    ):
+        self.max_sessions = max_sessions
+        self.tail_size = tail_size
+        self.compact_interval = compact_interval
+        self.session_factory = session_factory
+        self._cache: "OrderedDict[SessionKey, _CachedSession]" = OrderedDict()
+        # Полосатые блокировки: сериализуют запись в одну сессию внутри процесса
+        self._locks = [asyncio.Lock() for _ in range(64)]
+
+    def _lock(self, key: SessionKey) -> asyncio.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _remember(self, key: SessionKey, cached: _CachedSession) -> None:
+        self._cache[key] = cached
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_sessions:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: SessionKey) -> _CachedSession:
+        """Актуальное состояние сессии: из кэша, если он совпадает с базой"""
+        user_id, code = key
+        async with self.session_factory() as session:
+            row = await session.get(TplSession, key)
+            base_seq, head_seq = (row.base_seq, row.head_seq) if row else (0, 0)
+            cached = self._cache.get(key)
+            if cached is not None and cached.base_seq == base_seq and cached.head_seq == head_seq:
+                self._cache.move_to_end(key)
+                return cached
+            cached = _CachedSession(base_seq, head_seq, self.tail_size)
+            if head_seq > base_seq:
+                result = await session.execute(
+                    select(TplHistoryEntry)
+                    .where(
+                        TplHistoryEntry.user_id == user_id,
+                        TplHistoryEntry.code == code,
+                        TplHistoryEntry.seq > base_seq,
+                        TplHistoryEntry.seq <= head_seq
+                    )
+                    .order_by(TplHistoryEntry.seq.desc())
+                    .limit(self.tail_size)
+                )
+                for entry in reversed(result.scalars().all()):
+                    cached.tail.append((entry.seq, _entry_to_item(entry)))
+        self._remember(key, cached)
+        return cached
+
+    async def head(self, user_id: str, code: str) -> int:
+        """Номер последней записи сессии"""
+        return (await self._load((user_id, code))).head_seq
+
+    async def append(
+        self,
+        user_id: str,
+        code: str,
+        items: List[dict],
+        expected_seq: Optional[int] = None
+    ) -> int:
+        """Дописывает записи в конец лога, возвращает новый head_seq.
+
+        Если задан expected_seq, запись выполняется только когда head_seq сессии
+        с ним совпадает, иначе 409.
+        """
+        key = (user_id, code)
+        async with self._lock(key):
+            async with self.session_factory() as session:
+                # Строка сессии должна существовать, чтобы FOR UPDATE было что блокировать
+                await session.execute(
+                    insert_ignore(session, TplSession).values(user_id=user_id, code=code, base_seq=0, head_seq=0)
+                )
+                row = await session.get(TplSession, key, with_for_update=True)
+                if expected_seq is not None and row.head_seq != expected_seq:
+                    raise HTTPException(
+                        status_code=409,
+                        detail="History is out of sync",
+                        headers={"X-History-Seq": str(row.head_seq)}
+                    )
+                cached = self._cache.get(key)
+                if cached is not None and (cached.base_seq, cached.head_seq) != (row.base_seq, row.head_seq):
+                    # Сессию дописал или сбросил другой инстанс — кэш устарел
+                    del self._cache[key]
+                    cached = None
+                appended = []
+                for item in items:
+                    row.head_seq += 1
+                    appended.append((row.head_seq, item))
+                    session.add(TplHistoryEntry(
+                        user_id=user_id,
+                        code=code,
+                        seq=row.head_seq,
+                        t=item["t"],
+                        text=item.get("text"),
+                        files=item.get("files")
+                    ))
+                head_seq = row.head_seq
+                await session.commit()
+            if cached is not None:
+                cached.tail.extend(appended)
+                cached.head_seq = head_seq
+            return head_seq
+
+    async def history(self, user_id: str, code: str, since_seq: Optional[int] = None) -> Tuple[int, List[dict]]:
+        """Записи после сброса (или после since_seq, если он больше) и текущий head_seq"""
+        key = (user_id, code)
+        cached = await self._load(key)
+        start = max(cached.base_seq, since_seq or 0)
+        if cached.covers(start):
+            return cached.head_seq, [item for seq, item in cached.tail if seq > start]
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(TplHistoryEntry)
+                .where(
+                    TplHistoryEntry.user_id == user_id,
+                    TplHistoryEntry.code == code,
+                    TplHistoryEntry.seq > start,
+                    TplHistoryEntry.seq <= cached.head_seq
+                )
+                .order_by(TplHistoryEntry.seq)
+            )
+            return cached.head_seq, [_entry_to_item(entry) for entry in result.scalars().all()]
+
+    async def reset(self, user_id: str, code: str) -> None:
+        """Сбрасывает историю сессии, не удаляя записи из лога"""
+        key = (user_id, code)
+        async with self._lock(key):
+            async with self.session_factory() as session:
+                await session.execute(
+                    update(TplSession)
+                    .where(TplSession.user_id == user_id, TplSession.code == code)
+                    .values(base_seq=TplSession.head_seq)
+                )
+                await session.commit()
+            # Кэш мог отставать от базы, поэтому не правим его, а перечитываем при обращении
+            self._cache.pop(key, None)
+
+    async def compact(self) -> int:
+        """Удаляет записи, скрытые reset (seq <= base_seq), возвращает их число.
+
+        Чтение и кэш используют только записи после base_seq, поэтому
+        компакция не требует блокировок сессий.
+        """
+        base_seq = (
+            select(TplSession.base_seq)
+            .where(TplSession.user_id == TplHistoryEntry.user_id, TplSession.code == TplHistoryEntry.code)
+            .scalar_subquery()
+        )
+        async with self.session_factory() as session:
+            result = await session.execute(delete(TplHistoryEntry).where(TplHistoryEntry.seq <= base_seq))
+            await session.commit()
+        return result.rowcount
+
+    async def run_compaction(self) -> None:
+        """Периодическая компакция; запускается фоновой задачей при старте приложения"""
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                removed = await self.compact()
+                logger.info(f"Compacted {removed} tpl history entries")
+            except Exception as e:
+                logger.error(f"Tpl history compaction failed: {e}")
+
+# Создаём экземпляр хранилища
+tpl_session_store = TplSessionStore(
+    max_sessions=int(os.getenv("TPL_SESSION_CACHE_SIZE", "1000")),
+    tail_size=int(os.getenv("TPL_SESSION_TAIL_SIZE", "50")),
+    compact_interval=float(os.getenv("TPL_COMPACT_INTERVAL", "3600"))
+)
@@ -0,0 +1,356 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Виды спанов в терминах OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_ERROR = 2
+
+class Span:
+    """Спан трассировки. Несэмплированные спаны ничего не записывают"""
+
+    __slots__ = (
+        "name", "kind", "trace_id", "span_id", "parent_id", "sampled",
+        "start_ns", "end_ns", "attributes", "status"
+    )
+
+    def __init__(
+        self,
+        name: str,
+        kind: int,
+        trace_id: int,
+        span_id: int,
+        parent_id: Optional[int],
+        sampled: bool
+    ):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns() if sampled else 0
+        self.end_ns = 0
+        self.attributes: Dict[str, Any] = {}
+        self.status = 0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None, end_ns: Optional[int] = None) -> None:
+        if not self.sampled or self.end_ns:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if error is not None:
+            self.status = STATUS_ERROR
+            self.attributes["exception.type"] = type(error).__name__
+            self.attributes["exception.message"] = str(error)
+        tracer.exporter.export(self)
+
+    def traceparent(self) -> Optional[str]:
+        """Заголовок W3C traceparent для передачи контекста в upstream"""
+        if not self.trace_id:
+            return None
+        return f"00-{self.trace_id:032x}-{self.span_id:016x}-{'01' if self.sampled else '00'}"
+
+# Несэмплированный корневой контекст без входящего traceparent: нечего передавать дальше
+UNSAMPLED = Span("", SPAN_KIND_INTERNAL, 0, 0, None, False)
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+_LOWER_HEX = re.compile("[0-9a-f]+")
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[int, int, bool]]:
+    """Разбирает traceparent в (trace_id, parent_span_id, sampled)"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff":
+        return None
+    # Версия 00 — ровно четыре поля; более новые версии могут дописывать поля в конец
+    if parts[0] == "00" and len(parts) != 4:
+        return None
+    if len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    # Только строчный hex: int(x, 16) пропустил бы верхний регистр, "_" и "+"
+    if not all(_LOWER_HEX.fullmatch(part) for part in parts[:4]):
+        return None
+    trace_id = int(parts[1], 16)
+    span_id = int(parts[2], 16)
+    if not trace_id or not span_id:
+        return None
+    return trace_id, span_id, bool(int(parts[3], 16) & 1)
+
+def _span_to_otlp(span: Span) -> Dict[str, Any]:
+    data = {
+        "traceId": f"{span.trace_id:032x}",
+        "spanId": f"{span.span_id:016x}",
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+        "status": {"code": span.status},
+    }
+    if span.parent_id:
+        data["parentSpanId"] = f"{span.parent_id:016x}"
+    return data
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+class BatchSpanExporter:
+    """Копит завершённые спаны и пишет их пачками в фоновом потоке.
+
+    Каждая пачка — одна строка OTLP/JSON (ExportTraceServiceRequest) в stdout
+    или файл. При переполнении очереди спаны отбрасываются, а не блокируют запрос.
+    """
+
+    def __init__(self, target: str, batch_size: int, interval: float, queue_size: int):
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        batch: List[Span] = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                span = None
+            else:
+                if span is None:
+                    self._flush(batch)
+                    return
+                batch.append(span)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.interval
+
+    def _flush(self, batch: List[Span]) -> None:
+        if not batch:
+            return
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", "api-gateway")]},
+                "scopeSpans": [{
+                    "scope": {"name": "gateway"},
+                    "spans": [_span_to_otlp(span) for span in batch],
+                }],
+            }]
+        }
+        line = json.dumps(payload) + "\n"
+        try:
+            if self.target == "stdout":
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                with open(self.target, "a") as f:
+                    f.write(line)
+        except OSError as e:
+            logger.error(f"Span export failed: {e}")
+
+    def shutdown(self) -> None:
+        """Дописывает оставшиеся спаны и останавливает поток"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+class Tracer:
+    def __init__(self, sample_rate: float, exporter: BatchSpanExporter):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    def start_root_span(self, name: str, traceparent: Optional[str] = None) -> Span:
+        """Входящий запрос: продолжает трейс из traceparent или начинает новый"""
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if not sampled:
+                # Не пишем спан, но передаём контекст вызывающего дальше как есть
+                return Span(name, SPAN_KIND_SERVER, trace_id, parent_id, None, False)
+        elif random.random() < self.sample_rate:
+            trace_id, parent_id = random.getrandbits(128), None
+        else:
+            return UNSAMPLED
+        return Span(name, SPAN_KIND_SERVER, trace_id, random.getrandbits(64), parent_id, True)
+
+    def start_span(self, name: str, kind: int = SPAN_KIND_INTERNAL) -> Span:
+        """Дочерний спан текущего; вне запроса трассировка не ведётся"""
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return parent or UNSAMPLED
+        return Span(name, kind, parent.trace_id, random.getrandbits(64), parent.span_id, True)
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL):
+        span = self.start_span(name, kind)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=e)
+            raise
+        else:
+            span.end()
+        finally:
+            _current_span.reset(token)
+
+class UpstreamPhaseRecorder:
+    """Callback для расширения httpx `trace`: пишет фазы upstream-вызова дочерними спанами.
+
+    DNS-резолв выполняется внутри connect_tcp и попадает в фазу connect.
+    """
+
+    PHASES = {
+        "connect_tcp": "connect",
+        "start_tls": "tls",
+        "send_request_headers": "send",
+        "send_request_body": "send",
+        "receive_response_headers": "ttfb",
+        "receive_response_body": "body",
+    }
+
+    def __init__(self, parent: Span):
+        self.parent = parent
+        self._started: Dict[str, int] = {}
+
+    async def __call__(self, event_name: str, info: Dict[str, Any]) -> None:
+        _, step, stage = event_name.rsplit(".", 2) if event_name.count(".") >= 2 else ("", "", "")
+        phase = self.PHASES.get(step)
+        if phase is None:
+            return
+        if stage == "started":
+            self._started.setdefault(step, time.time_ns())
+            return
+        start_ns = self._started.pop(step, None)
+        if start_ns is None:
+            return
+        span = Span(
+            phase, SPAN_KIND_INTERNAL, self.parent.trace_id,
+            random.getrandbits(64), self.parent.span_id, True
+        )
+        span.start_ns = start_ns
+        span.end(error=info.get("exception") if stage == "failed" else None)
+
+class TracingMiddleware:
+    """ASGI-middleware: спан SERVER на каждый входящий HTTP-запрос"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        span = tracer.start_root_span(scope["method"], traceparent)
+        token = _current_span.set(span)
+        if not span.sampled:
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                _current_span.reset(token)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    span.status = STATUS_ERROR
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", scope["path"])
+            span.name = f"{scope['method']} {path}"
+            span.set_attribute("http.method", scope["method"])
+            span.set_attribute("http.route", path)
+            span.end(error=error)
+            _current_span.reset(token)
+
+def instrument_engine(engine) -> None:
+    """Спаны CLIENT на каждый SQL-запрос через движок SQLAlchemy"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        span = tracer.start_span("db.query", SPAN_KIND_CLIENT)
+        if span.sampled:
+            span.set_attribute("db.system", conn.dialect.name)
+            span.set_attribute("db.statement", statement)
+            context._trace_span = span
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_trace_span", None)
+        if span is not None:
+            span.end()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        span = getattr(exception_context.execution_context, "_trace_span", None)
+        if span is not None:
+            span.end(error=exception_context.original_exception)
+
+exporter = BatchSpanExporter(
+    target=os.getenv("TRACE_EXPORT_FILE", "stdout"),
+    batch_size=int(os.getenv("TRACE_BATCH_SIZE", "512")),
+    interval=float(os.getenv("TRACE_EXPORT_INTERVAL", "5")),
+    queue_size=int(os.getenv("TRACE_QUEUE_SIZE", "4096"))
+)
+
+# Создаём экземпляр трейсера
+tracer = Tracer(float(os.getenv("TRACE_SAMPLE_RATE", "0")), exporter)
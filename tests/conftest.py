@@ -0,0 +1,20 @@
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from models.user import Base
+import models.idempotency
+import models.tpl_session
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    """Фабрика сессий к отдельной SQLite-базе; вызывать внутри event loop теста"""
+    pytest.importorskip("aiosqlite")
+
+    async def factory():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    return factory
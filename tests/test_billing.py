@@ -0,0 +1,77 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from routers import billing
+from services.idempotency import InMemoryIdempotencyStore
+from services.microservice_client import microservice_client
+
+DEBIT = {"user_id": "u1", "action": "chat", "units": 1, "reason": "test"}
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Шлюз с billing-роутером; ответы billing задаёт тест через `handle`"""
+    calls = []
+    state = {"handle": lambda request: httpx.Response(200, json={"balance": 9, "tx_id": "tx-1"})}
+
+    def transport(request):
+        calls.append(request)
+        return state["handle"](request)
+
+    monkeypatch.setattr(
+        billing, "idempotency_store",
+        InMemoryIdempotencyStore(ttl=60, pending_ttl=60, poll_timeout=0.1, max_entries=100)
+    )
+    monkeypatch.setattr(microservice_client, "client", httpx.AsyncClient(transport=httpx.MockTransport(transport)))
+    app = FastAPI()
+    app.include_router(billing.router)
+    with TestClient(app) as client:
+        yield client, calls, state
+
+
+@pytest.mark.parametrize("key", ["", "a b", "k" * 256])
+def test_invalid_idempotency_key_is_rejected(gateway, key):
+    client, calls, _ = gateway
+    response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": key})
+    assert response.status_code == 400
+    assert not calls
+
+
+def test_key_is_forwarded_and_replayed(gateway):
+    client, calls, _ = gateway
+    for _ in range(2):
+        response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": "k1"})
+        assert response.json() == {"balance": 9, "tx_id": "tx-1"}
+    assert len(calls) == 1
+    assert calls[0].headers["Idempotency-Key"] == "k1"
+
+
+def test_timed_out_debit_is_not_repeated(gateway):
+    client, calls, state = gateway
+
+    def timeout(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    state["handle"] = timeout
+    response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 503
+    # billing мог выполнить списание — повтор не доходит до него, пока ключ pending
+    response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 409
+    assert len(calls) == 1
+
+
+def test_debit_that_could_not_connect_is_retried(gateway):
+    client, calls, state = gateway
+
+    def refused(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    state["handle"] = refused
+    response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 503
+    state["handle"] = lambda request: httpx.Response(200, json={"balance": 9, "tx_id": "tx-1"})
+    response = client.post("/billing/quota/debit", json=DEBIT, headers={"Idempotency-Key": "k1"})
+    assert response.status_code == 200
+    assert len(calls) == 2
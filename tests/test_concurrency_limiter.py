@@ -0,0 +1,144 @@
+import asyncio
+import random
+import pytest
+from fastapi import HTTPException
+from services.concurrency_limiter import (
+    AdaptiveConcurrencyLimiter, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK, classify_priority
+)
+
+
+def make_limiter(**kwargs):
+    params = dict(initial_limit=1, min_limit=1, max_limit=10, max_queue=2, queue_timeout=1)
+    params.update(kwargs)
+    return AdaptiveConcurrencyLimiter("billing", **params)
+
+
+def test_interactive_request_evicts_queued_bulk_request():
+    async def scenario():
+        limiter = make_limiter(max_limit=1)
+        await limiter.acquire()
+        bulk = asyncio.create_task(limiter.acquire(PRIORITY_BULK))
+        normal = asyncio.create_task(limiter.acquire(PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(limiter.acquire(PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as exc:
+            await bulk
+        assert exc.value.status_code == 503
+        assert int(exc.value.headers["Retry-After"]) >= 1
+
+        # Освободившийся слот достаётся самому важному ожидающему
+        limiter.release(0.01)
+        await interactive
+        assert not normal.done()
+        limiter.release(0.01)
+        await normal
+        limiter.release(0.01)
+        assert limiter.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_sheds_request_of_equal_priority():
+    async def scenario():
+        limiter = make_limiter()
+        await limiter.acquire()
+        waiters = [asyncio.create_task(limiter.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc:
+            await limiter.acquire()
+        assert exc.value.status_code == 503
+        for _ in waiters:
+            limiter.release(0.01)
+        await asyncio.gather(*waiters)
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_returns_503_and_keeps_slots_consistent():
+    async def scenario():
+        limiter = make_limiter(queue_timeout=0.05)
+        await limiter.acquire()
+        with pytest.raises(HTTPException) as exc:
+            await limiter.acquire()
+        assert exc.value.status_code == 503
+        assert "Retry-After" in exc.value.headers
+        limiter.release(0.01)
+        assert limiter.in_flight == 0
+        await limiter.acquire()
+        assert limiter.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_limit_backs_off_on_slow_or_failed_responses():
+    async def scenario():
+        clock = FakeClock()
+        limiter = make_limiter(initial_limit=8, clock=clock)
+        for rtt in (0.01, 0.01):
+            await limiter.acquire()
+            limiter.release(rtt)
+        before = limiter.limit
+        clock.now += 1
+        await limiter.acquire()
+        limiter.release(0.5)
+        assert limiter.limit < before
+        before = limiter.limit
+        clock.now += 1
+        await limiter.acquire()
+        limiter.release(0.01, dropped=True)
+        assert limiter.limit < before
+
+    asyncio.run(scenario())
+
+
+def test_limit_changes_at_most_once_per_rtt():
+    async def scenario():
+        clock = FakeClock()
+        limiter = make_limiter(initial_limit=10, clock=clock)
+        await limiter.acquire()
+        limiter.release(0.01)
+        clock.now += 1
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(0.01, dropped=True)
+        assert limiter.limit == pytest.approx(10 * limiter.backoff, rel=0.05)
+
+    asyncio.run(scenario())
+
+
+def test_limit_is_stable_under_normal_jitter():
+    async def scenario():
+        rng = random.Random(1)
+        clock = FakeClock()
+        limiter = make_limiter(initial_limit=20, max_limit=200, max_queue=100, clock=clock)
+        for _ in range(500):
+            # Держим лимит загруженным, как 16+ параллельных клиентов
+            for _ in range(int(limiter.limit)):
+                await limiter.acquire()
+            for _ in range(int(limiter.limit)):
+                rtt = 0.020 + rng.uniform(-0.005, 0.005)
+                if rng.random() < 0.02:
+                    # Редкие выбросы (GC, переключение контекста) не должны обрушивать лимит
+                    rtt = 0.060
+                clock.now += rtt / 10
+                limiter.release(rtt)
+        assert limiter.limit >= 20
+
+    asyncio.run(scenario())
+
+
+def test_classify_priority():
+    assert classify_priority("/billing/balance") == PRIORITY_INTERACTIVE
+    assert classify_priority("/conversation/") == PRIORITY_INTERACTIVE
+    assert classify_priority("/upload_conversations/") == PRIORITY_BULK
+    assert classify_priority("/billing/quota/debit") == PRIORITY_NORMAL
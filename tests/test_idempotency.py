@@ -0,0 +1,147 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from services.errors import UpstreamNotReached
+from services.idempotency import InMemoryIdempotencyStore, PostgresIdempotencyStore
+
+
+def make_billing(delay=0.05):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return {"tx_id": f"tx-{len(calls)}"}
+
+    return call, calls
+
+
+def memory_store(**kwargs):
+    params = dict(ttl=60, pending_ttl=60, poll_timeout=1, max_entries=100)
+    params.update(kwargs)
+    return InMemoryIdempotencyStore(**params)
+
+
+def test_concurrent_duplicates_call_billing_once():
+    async def scenario():
+        store = memory_store()
+        call, calls = make_billing()
+        results = await asyncio.gather(*[store.execute("k", "f", call) for _ in range(5)])
+        assert results == [{"tx_id": "tx-1"}] * 5
+        assert await store.execute("k", "f", call) == {"tx_id": "tx-1"}
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_key_reuse_with_different_body_is_rejected():
+    async def scenario():
+        store = memory_store()
+        call, _ = make_billing(0)
+        await store.execute("k", "f", call)
+        with pytest.raises(HTTPException) as exc:
+            await store.execute("k", "other", call)
+        assert exc.value.status_code == 422
+
+    asyncio.run(scenario())
+
+
+def test_request_that_did_not_reach_billing_can_be_retried():
+    async def scenario():
+        store = memory_store()
+        attempts = []
+
+        async def failing():
+            attempts.append(1)
+            raise UpstreamNotReached(status_code=503)
+
+        for _ in range(2):
+            with pytest.raises(HTTPException):
+                await store.execute("k", "f", failing)
+        assert len(attempts) == 2
+
+    asyncio.run(scenario())
+
+
+def test_ambiguous_failure_keeps_key_pending():
+    async def scenario():
+        store = memory_store(poll_timeout=0.1)
+        attempts = []
+
+        async def timing_out():
+            attempts.append(1)
+            raise HTTPException(status_code=503)
+
+        with pytest.raises(HTTPException) as exc:
+            await store.execute("k", "f", timing_out)
+        assert exc.value.status_code == 503
+        with pytest.raises(HTTPException) as exc:
+            await store.execute("k", "f", timing_out)
+        assert exc.value.status_code == 409
+        assert len(attempts) == 1
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("key", ["", " ", "a b", "k" * 256])
+def test_invalid_key_is_rejected(key):
+    async def scenario():
+        store = memory_store()
+        call, calls = make_billing(0)
+        with pytest.raises(HTTPException) as exc:
+            await store.execute(key, "f", call, scope="/internal/billing/debit")
+        assert exc.value.status_code == 400
+        assert not calls
+
+    asyncio.run(scenario())
+
+
+def test_save_failure_returns_result_and_blocks_retry():
+    async def scenario():
+        store = memory_store(poll_timeout=0.1)
+        call, calls = make_billing(0)
+
+        async def broken_complete(key, response):
+            raise RuntimeError("db is down")
+
+        store._complete = broken_complete
+        assert await store.execute("k", "f", call) == {"tx_id": "tx-1"}
+        with pytest.raises(HTTPException) as exc:
+            await store.execute("k", "f", call)
+        assert exc.value.status_code == 409
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_original_client_disconnect_does_not_cancel_duplicates():
+    async def scenario():
+        store = memory_store()
+        call, calls = make_billing(0.1)
+        original = asyncio.create_task(store.execute("k", "f", call))
+        await asyncio.sleep(0.01)
+        duplicate = asyncio.create_task(store.execute("k", "f", call))
+        await asyncio.sleep(0.01)
+        original.cancel()
+        assert await duplicate == {"tx_id": "tx-1"}
+        assert original.cancelled()
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_shared_store_deduplicates_across_instances(make_db):
+    async def scenario():
+        session_factory = await make_db()
+        first = PostgresIdempotencyStore(60, 60, 2, session_factory=session_factory)
+        second = PostgresIdempotencyStore(60, 60, 2, session_factory=session_factory)
+        call, calls = make_billing(0.2)
+        results = await asyncio.gather(
+            first.execute("k", "f", call),
+            second.execute("k", "f", call)
+        )
+        assert results == [{"tx_id": "tx-1"}] * 2
+        assert await second.execute("k", "f", call) == {"tx_id": "tx-1"}
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
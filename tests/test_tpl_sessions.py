@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from services.tpl_sessions import TplSessionStore
+
+
+def item(text):
+    return {"t": "user", "text": text, "files": None}
+
+
+def texts(items):
+    return [entry["text"] for entry in items]
+
+
+def two_instances(make_db, tail_size=50):
+    async def build():
+        session_factory = await make_db()
+        return (
+            TplSessionStore(100, tail_size, session_factory=session_factory),
+            TplSessionStore(100, tail_size, session_factory=session_factory),
+        )
+    return build()
+
+
+def test_history_delta_and_reset(make_db):
+    async def scenario():
+        store, _ = await two_instances(make_db, tail_size=2)
+        for text in ("a", "b", "c"):
+            await store.append("u", "c", [item(text)])
+        head, items = await store.history("u", "c")
+        assert head == 3 and texts(items) == ["a", "b", "c"]
+        _, delta = await store.history("u", "c", since_seq=1)
+        assert texts(delta) == ["b", "c"]
+        await store.reset("u", "c")
+        assert await store.history("u", "c") == (3, [])
+
+    asyncio.run(scenario())
+
+
+def test_reset_on_other_instance_hides_cached_history(make_db):
+    async def scenario():
+        first, second = await two_instances(make_db)
+        await first.append("u", "c", [item("secret")])
+        assert texts((await first.history("u", "c"))[1]) == ["secret"]
+        await second.reset("u", "c")
+        assert await first.history("u", "c") == (1, [])
+
+    asyncio.run(scenario())
+
+
+def test_append_on_other_instance_is_visible(make_db):
+    async def scenario():
+        first, second = await two_instances(make_db)
+        await first.append("u", "c", [item("a")])
+        assert await first.head("u", "c") == 1
+        await second.append("u", "c", [item("b")])
+        assert await first.head("u", "c") == 2
+        assert texts((await first.history("u", "c"))[1]) == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_append_after_foreign_reset_does_not_resurrect_history(make_db):
+    async def scenario():
+        first, second = await two_instances(make_db)
+        await first.append("u", "c", [item("old")])
+        await first.history("u", "c")
+        await second.reset("u", "c")
+        await first.append("u", "c", [item("x")])
+        assert texts((await first.history("u", "c"))[1]) == ["x"]
+
+    asyncio.run(scenario())
+
+
+def test_first_append_from_two_instances(make_db):
+    async def scenario():
+        first, second = await two_instances(make_db)
+        heads = await asyncio.gather(
+            first.append("u", "c", [item("a")]),
+            second.append("u", "c", [item("b")])
+        )
+        assert sorted(heads) == [1, 2]
+        assert len((await first.history("u", "c"))[1]) == 2
+
+    asyncio.run(scenario())
+
+
+def test_append_with_stale_expected_seq_is_rejected(make_db):
+    async def scenario():
+        first, second = await two_instances(make_db)
+        await first.append("u", "c", [item("a")])
+        await second.append("u", "c", [item("b")])
+        with pytest.raises(HTTPException) as exc:
+            await first.append("u", "c", [item("c")], expected_seq=1)
+        assert exc.value.status_code == 409
+        assert exc.value.headers["X-History-Seq"] == "2"
+
+    asyncio.run(scenario())
+
+
+def test_compact_removes_only_reset_entries(make_db):
+    async def scenario():
+        store, other = await two_instances(make_db)
+        await store.append("u", "c", [item("a"), item("b")])
+        await store.reset("u", "c")
+        await store.append("u", "c", [item("c")])
+        await store.append("u", "other", [item("x")])
+        await other.history("u", "c")
+
+        assert await store.compact() == 2
+        assert await store.compact() == 0
+        assert await other.history("u", "c") == (3, [item("c")])
+        assert texts((await store.history("u", "c", since_seq=0))[1]) == ["c"]
+        assert texts((await store.history("u", "other"))[1]) == ["x"]
+        # Нумерация продолжается после компакции
+        assert await store.append("u", "c", [item("d")]) == 4
+
+    asyncio.run(scenario())
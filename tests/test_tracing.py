@@ -0,0 +1,184 @@
+import asyncio
+import json
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from services import tracing
+from services.microservice_client import microservice_client
+from services.tracing import (
+    BatchSpanExporter, Span, SPAN_KIND_CLIENT, SPAN_KIND_SERVER, TracingMiddleware,
+    UpstreamPhaseRecorder, instrument_engine, parse_traceparent
+)
+
+TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+SPAN_ID = "b7ad6b7169203331"
+
+
+def read_spans(path):
+    if not path.exists():
+        return []
+    return [
+        span
+        for line in path.read_text().splitlines()
+        for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    ]
+
+
+def attributes(span):
+    return {item["key"]: next(iter(item["value"].values())) for item in span["attributes"]}
+
+
+@pytest.fixture
+def spans(tmp_path, monkeypatch):
+    """Пишет спаны в файл; вызов фикстуры дописывает очередь и возвращает спаны"""
+    target = tmp_path / "spans.jsonl"
+    exporter = BatchSpanExporter(str(target), batch_size=100, interval=0.05, queue_size=100)
+    monkeypatch.setattr(tracing.tracer, "exporter", exporter)
+    monkeypatch.setattr(tracing.tracer, "sample_rate", 1.0)
+
+    def collect():
+        exporter.shutdown()
+        return read_spans(target)
+
+    return collect
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        return {"id": item_id}
+
+    return app
+
+
+def test_parses_valid_header():
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-01") == (int(TRACE_ID, 16), int(SPAN_ID, 16), True)
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-00")[2] is False
+
+
+def test_rejects_malformed_version_00():
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-01-extra") is None
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-1") is None
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-011") is None
+    assert parse_traceparent(f"00-{'0' * 32}-{SPAN_ID}-01") is None
+    assert parse_traceparent(f"ff-{TRACE_ID}-{SPAN_ID}-01") is None
+
+
+def test_rejects_non_lowercase_hex():
+    assert parse_traceparent(f"00-{TRACE_ID.upper()}-{SPAN_ID}-01") is None
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID[:-2]}_1-01") is None
+    assert parse_traceparent(f"00-{TRACE_ID}-{SPAN_ID}-+1") is None
+    assert parse_traceparent(f"0A-{TRACE_ID}-{SPAN_ID}-01") is None
+
+
+def test_future_versions_may_append_fields():
+    assert parse_traceparent(f"01-{TRACE_ID}-{SPAN_ID}-01-extra") is not None
+
+
+def test_middleware_records_server_span(app, spans):
+    with TestClient(app) as client:
+        assert client.get("/items/1").status_code == 200
+    [span] = spans()
+    assert span["name"] == "GET /items/{item_id}"
+    assert span["kind"] == SPAN_KIND_SERVER
+    assert "parentSpanId" not in span
+    assert attributes(span)["http.status_code"] == "200"
+
+
+def test_sampling_follows_rate_and_incoming_flag(app, spans, monkeypatch):
+    monkeypatch.setattr(tracing.tracer, "sample_rate", 0.0)
+    with TestClient(app) as client:
+        client.get("/items/1")
+        client.get("/items/2", headers={"traceparent": f"00-{TRACE_ID}-{SPAN_ID}-00"})
+        client.get("/items/3", headers={"traceparent": f"00-{TRACE_ID}-{SPAN_ID}-01"})
+    [span] = spans()
+    # Сэмплирован только запрос, который вызывающий пометил флагом 01
+    assert span["traceId"] == TRACE_ID
+    assert span["parentSpanId"] == SPAN_ID
+
+
+def test_proxy_request_propagates_traceparent(spans, monkeypatch):
+    seen = []
+
+    def transport(request):
+        seen.append(request.headers.get("traceparent"))
+        return httpx.Response(200, json={"balance": 1})
+
+    monkeypatch.setattr(microservice_client, "client", httpx.AsyncClient(transport=httpx.MockTransport(transport)))
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/balance")
+    async def balance():
+        return await microservice_client.proxy_request("billing", "GET", "/internal/billing/balance")
+
+    with TestClient(app) as client:
+        client.get("/balance")
+        client.get("/balance", headers={"traceparent": f"00-{TRACE_ID}-{SPAN_ID}-00"})
+    server, upstream = sorted(spans(), key=lambda span: span["kind"] != SPAN_KIND_SERVER)
+    assert upstream["kind"] == SPAN_KIND_CLIENT
+    assert upstream["parentSpanId"] == server["spanId"]
+    assert seen[0] == f"00-{upstream['traceId']}-{upstream['spanId']}-01"
+    # Несэмплированный контекст вызывающего передаётся дальше без изменений
+    assert seen[1] == f"00-{TRACE_ID}-{SPAN_ID}-00"
+
+
+def test_upstream_phases_become_child_spans(spans):
+    async def scenario():
+        parent = Span("GET billing", SPAN_KIND_CLIENT, int(TRACE_ID, 16), int(SPAN_ID, 16), None, True)
+        recorder = UpstreamPhaseRecorder(parent)
+        for step in ("connect_tcp", "send_request_headers", "receive_response_headers"):
+            await recorder(f"http11.{step}.started", {})
+            await recorder(f"http11.{step}.complete", {})
+        await recorder("http11.receive_response_body.started", {})
+        await recorder("http11.receive_response_body.failed", {"exception": ConnectionResetError("reset")})
+        await recorder("http11.response_closed.complete", {})
+
+    asyncio.run(scenario())
+    phases = {span["name"]: span for span in spans()}
+    assert set(phases) == {"connect", "send", "ttfb", "body"}
+    assert all(span["parentSpanId"] == SPAN_ID for span in phases.values())
+    assert phases["body"]["status"]["code"] == tracing.STATUS_ERROR
+
+
+def test_db_queries_become_client_spans(make_db, spans):
+    async def scenario():
+        session_factory = await make_db()
+        instrument_engine(session_factory.kw["bind"])
+        async with session_factory() as session:
+            # Вне входящего запроса спаны не пишутся
+            await session.execute(text("SELECT 1"))
+            tracing._current_span.set(tracing.tracer.start_root_span("GET"))
+            with tracing.tracer.span("parent") as parent:
+                await session.execute(text("SELECT 2"))
+            return parent
+
+    parent = asyncio.run(scenario())
+    [span] = [span for span in spans() if span["name"] == "db.query"]
+    assert span["kind"] == SPAN_KIND_CLIENT
+    assert span["parentSpanId"] == f"{parent.span_id:016x}"
+    assert attributes(span)["db.statement"] == "SELECT 2"
+    assert attributes(span)["db.system"] == "sqlite"
+
+
+def test_exporter_batches_and_flushes_on_shutdown(tmp_path):
+    target = tmp_path / "spans.jsonl"
+    exporter = BatchSpanExporter(str(target), batch_size=2, interval=60, queue_size=100)
+    for i in range(5):
+        span = Span(f"span-{i}", SPAN_KIND_CLIENT, 1, i + 1, None, True)
+        span.end_ns = span.start_ns + 1
+        exporter.export(span)
+    exporter.shutdown()
+    batches = [len(json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"])
+               for line in target.read_text().splitlines()]
+    assert batches == [2, 2, 1]
+    # После остановки экспортёр можно запустить снова
+    exporter.export(Span("late", SPAN_KIND_CLIENT, 1, 9, None, True))
+    exporter.shutdown()
+    assert len(read_spans(target)) == 6